@@ -0,0 +1,24 @@
+"""Kernel for min-max normalizing the numeric feature vector.
+
+Uses the ahead-of-time compiled eta_kernel module (see compile_kernel.py)
+when available, so there is no JIT pause on cold start; otherwise the same
+function is JIT-compiled with Numba.
+"""
+
+
+def _normalize_py(vals, mins, inv_ranges, out):
+    for i in range(vals.size):
+        out[i] = (vals[i] - mins[i]) * inv_ranges[i]
+
+
+try:
+    from eta_kernel import normalize_vec
+except ImportError:
+    import numpy as np
+    from numba import njit
+
+    normalize_vec = njit(cache=True)(_normalize_py)
+
+    # Compile (or load from the on-disk cache) at import, before the first request
+    _warmup = np.zeros(1, dtype=np.float32)
+    normalize_vec(_warmup, _warmup, _warmup, _warmup)
@@ -1,21 +1,31 @@
 import json
 import time
+import queue
+import threading
 import numpy as np
-import pandas as pd
-from flask import Flask, request, jsonify
+import msgspec
+from flask import Flask, Response, request
 from catboost import CatBoostRegressor
+from _normalize import normalize_vec
 import logging
+import logging.handlers
+import atexit
 import os
 
 # -------------------- CONFIGURATION --------------------
 app = Flask(__name__)
 
-# Setup Logging
-logging.basicConfig(
-    filename="eta_api.log",
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s"
-)
+# Setup Logging (file writes happen on a background listener thread)
+log_file_handler = logging.FileHandler("eta_api.log")
+log_file_handler.setFormatter(logging.Formatter("%(asctime)s | %(levelname)s | %(message)s"))
+
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.getLogger().setLevel(logging.INFO)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
 
 # Load models
 pickup_model = CatBoostRegressor()
@@ -26,6 +36,13 @@ delivery_model.load_model("catboost_delivery_eta_model.cbm")
 
 print("✅ Models loaded successfully (Pickup & Delivery)")
 
+# Include processing_time_sec in every response (otherwise only for ?debug=1)
+report_timing = os.environ.get("REPORT_PROCESSING_TIME", "false").lower() == "true"
+
+# Both models are RMSE on normalized targets, so the raw formula value is the prediction.
+# One thread per call: parallelism comes from gunicorn workers and request threads.
+PREDICT_OPTIONS = {"prediction_type": "RawFormulaVal", "thread_count": 1}
+
 # Load scaling parameters
 with open("pickup_scaling_params.json", "r") as f:
     pickup_scaling = json.load(f)
@@ -34,81 +51,270 @@ with open("delivery_scaling_params.json", "r") as f:
 with open("eta_scaling_params.json", "r") as f:
     eta_scaling = json.load(f)
 
+# Denormalization as eta_norm * scale + bias, precomputed per mode
+ETA_PARAMS = {
+    m: (eta_scaling[m]["eta_max"] - eta_scaling[m]["eta_min"], eta_scaling[m]["eta_min"])
+    for m in ("pickup", "delivery")
+}
+
+
+# Feature layout (column order must match training order)
+PICKUP_COLS = (
+    'city', 'lng', 'lat', 'aoi_type', 'pickup_distance_km',
+    'accept_hour', 'pickup_hour', 'accept_day', 'pickup_day',
+    'accept_month', 'pickup_month', 'accept_date', 'pickup_date',
+    'hour_bucket', 'day_type'
+)
+DELIVERY_COLS = (
+    'city', 'lng', 'lat', 'aoi_type', 'delivery_distance_km',
+    'accept_hour', 'delivery_hour', 'accept_day', 'delivery_day',
+    'accept_month', 'delivery_month', 'accept_date', 'delivery_date',
+    'day_type', 'hour_bucket'
+)
+PICKUP_CAT_FEATURES = ('city', 'accept_date', 'pickup_date', 'hour_bucket', 'day_type')
+DELIVERY_CAT_FEATURES = ('city', 'accept_date', 'delivery_date', 'day_type', 'hour_bucket')
+
+# Integer positions of categorical columns within the feature row
+PICKUP_CAT_IDX = frozenset(PICKUP_COLS.index(c) for c in PICKUP_CAT_FEATURES)
+DELIVERY_CAT_IDX = frozenset(DELIVERY_COLS.index(c) for c in DELIVERY_CAT_FEATURES)
+
+# Representative requests, used for model warm-up and manual testing
+SAMPLE_PICKUP_PAYLOAD = {
+    "city": "Chongqing",
+    "lng": 106.55,
+    "lat": 29.56,
+    "aoi_type": 1,
+    "pickup_distance_km": 2.3,
+    "accept_hour": 10,
+    "pickup_hour": 11,
+    "accept_day": 9,
+    "pickup_day": 9,
+    "accept_month": 10,
+    "pickup_month": 10,
+    "accept_date": "2025-10-09",
+    "pickup_date": "2025-10-09",
+    "hour_bucket": "Afternoon",
+    "day_type": "Weekday"
+}
+SAMPLE_DELIVERY_PAYLOAD = {
+    "city": "Chongqing",
+    "lng": 106.55,
+    "lat": 29.56,
+    "aoi_type": 1,
+    "delivery_distance_km": 2.8,
+    "accept_hour": 10,
+    "delivery_hour": 11,
+    "accept_day": 9,
+    "delivery_day": 9,
+    "accept_month": 10,
+    "delivery_month": 10,
+    "accept_date": "2025-10-09",
+    "delivery_date": "2025-10-09",
+    "day_type": "Weekday",
+    "hour_bucket": "Afternoon"
+}
+
+
+def build_scaling(cols, cat_idx, scaling_dict):
+    """Flatten scaling params into min / inverse-range arrays over numeric columns."""
+    num_idx = tuple(i for i in range(len(cols)) if i not in cat_idx)
+
+    # Numeric columns without scaling params (e.g. aoi_type) pass through unchanged
+    identity = {"min": 0.0, "max": 1.0}
+    mins = np.array([scaling_dict.get(cols[i], identity)["min"] for i in num_idx], dtype=np.float32)
+    maxs = np.array([scaling_dict.get(cols[i], identity)["max"] for i in num_idx], dtype=np.float32)
+    rng = maxs - mins
+    inv_range = np.divide(1.0, rng, out=np.zeros_like(rng), where=rng != 0)
+
+    return num_idx, mins, inv_range
+
+
+PICKUP_NUM_IDX, PICKUP_MIN, PICKUP_INV_RANGE = build_scaling(
+    PICKUP_COLS, PICKUP_CAT_IDX, pickup_scaling
+)
+DELIVERY_NUM_IDX, DELIVERY_MIN, DELIVERY_INV_RANGE = build_scaling(
+    DELIVERY_COLS, DELIVERY_CAT_IDX, delivery_scaling
+)
+
 
 # -------------------- HELPER FUNCTIONS --------------------
-def normalize_value(val, col, mode):
-    """Normalize real-world input using saved scaling parameters."""
-    scaling_dict = pickup_scaling if mode == "pickup" else delivery_scaling
-    if col not in scaling_dict:
-        return val
-    vmin = scaling_dict[col]["min"]
-    vmax = scaling_dict[col]["max"]
-    if vmax == vmin:
-        return 0
-    return (val - vmin) / (vmax - vmin)
-
-
-def preprocess_payload(payload, mode):
-    """Convert input payload to properly formatted DataFrame for prediction."""
-    df = pd.DataFrame([payload])
-
-    for c in df.columns:
-        try:
-            df[c] = df[c].astype(float)
-        except:
-            df[c] = df[c].astype(str)
-
-    cat_features = (
-        ['city', 'accept_date', 'pickup_date', 'hour_bucket', 'day_type']
-        if mode == "pickup"
-        else ['city', 'accept_date', 'delivery_date', 'day_type', 'hour_bucket']
-    )
+class PendingPrediction:
+    """A single row waiting in a BatchScheduler queue."""
+    __slots__ = ("X", "event", "result", "error")
+
+    def __init__(self, X):
+        self.X = X
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchScheduler:
+    """Coalesce concurrent single-row requests into one model.predict call per mode."""
+
+    def __init__(self, models, max_batch=32, batch_timeout_micros=2000):
+        self.max_batch = max_batch
+        self.batch_timeout = batch_timeout_micros / 1e6
+        self.queues = {}
+        for mode, model in models.items():
+            q = queue.Queue()
+            self.queues[mode] = q
+            threading.Thread(
+                target=self._run, args=(q, model), name=f"batch-{mode}", daemon=True
+            ).start()
+
+    def predict(self, mode, X):
+        """Enqueue a 1xN row and block until its normalized prediction is ready."""
+        pending = PendingPrediction(X)
+        self.queues[mode].put(pending)
+        pending.event.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self, q, model):
+        while True:
+            batch = [q.get()]
+            # Take whatever is already queued; a lone request is dispatched immediately
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Only wait for more rows when requests are actually arriving concurrently
+            if 1 < len(batch) < self.max_batch:
+                deadline = time.monotonic() + self.batch_timeout
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(q.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+
+            try:
+                preds = model.predict(np.vstack([p.X for p in batch]), **PREDICT_OPTIONS).tolist()
+                for p, pred in zip(batch, preds):
+                    p.result = pred
+            except Exception:
+                # Re-run row by row so one bad payload doesn't fail the whole batch
+                for p in batch:
+                    try:
+                        p.result = float(model.predict(p.X, **PREDICT_OPTIONS)[0])
+                    except Exception as e:
+                        p.error = e
+            for p in batch:
+                p.event.set()
+
+
+def make_predictor(mode, cols, cat_idx, num_idx, mins, inv_range, model, batcher, sample_payload):
+    """Build a predict(payload) closure with one mode's layout, scaling and models baked in."""
+    n_cols = len(cols)
+    num_cols = tuple(cols[i] for i in num_idx)
+    cat_cols = tuple(cols[i] for i in cat_idx)
+    scale, bias = ETA_PARAMS[mode]
+
+    # Per-thread 1xN row buffer, reused across requests
+    row_buffers = threading.local()
+
+    def build_features(payload, normalized=False):
+        vals = np.empty(len(num_cols), dtype=np.float32)
+        for j, col in enumerate(num_cols):
+            val = payload.get(col)
+            vals[j] = np.nan if val is None else float(val)
+        # Normalize in place with the compiled kernel (no numpy temporaries)
+        if not normalized:
+            normalize_vec(vals, mins, inv_range, vals)
+
+        cats = []
+        for col in cat_cols:
+            val = payload.get(col)
+            # JSON strings are already str; only coerce other values
+            if val is not None and type(val) is not str:
+                val = str(val)
+            cats.append(val)
+
+        return vals, cats
+
+    def build_row(vals, cats):
+        # Overwrite this thread's preallocated row instead of allocating a new array
+        X = getattr(row_buffers, "X", None)
+        if X is None:
+            X = row_buffers.X = np.empty((1, n_cols), dtype=object)
+
+        row = X[0]
+        for i, val in zip(num_idx, vals.tolist()):
+            row[i] = val
+        for i, val in zip(cat_idx, cats):
+            row[i] = np.nan if val is None else val
+
+        return X
+
+    def predict_eta(payload, normalized=False):
+        """Predict ETA (actual minutes) from real input data, or already-normalized features."""
+        vals, cats = build_features(payload, normalized)
+        eta_norm = float(batcher.predict(mode, build_row(vals, cats)))
+
+        return eta_norm * scale + bias, eta_norm
+
+    # Warm up the model so the first request doesn't pay for evaluator setup
+    model.predict(build_row(*build_features(sample_payload)), **PREDICT_OPTIONS)
+
+    return predict_eta
+
+
+# Micro-batching of concurrent /predict requests. A batch can't hold more rows than
+# there are request threads in this worker (see gunicorn.conf.py).
+worker_threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+batcher = BatchScheduler(
+    {"pickup": pickup_model, "delivery": delivery_model},
+    max_batch=min(int(os.environ.get("BATCH_MAX_SIZE", worker_threads)), worker_threads),
+    batch_timeout_micros=int(os.environ.get("BATCH_TIMEOUT_MICROS", "2000"))
+)
 
-    for cat in cat_features:
-        if cat in df.columns:
-            df[cat] = df[cat].astype(str)
-
-    expected_cols = (
-        ['city', 'lng', 'lat', 'aoi_type', 'pickup_distance_km',
-         'accept_hour', 'pickup_hour', 'accept_day', 'pickup_day',
-         'accept_month', 'pickup_month', 'accept_date', 'pickup_date',
-         'hour_bucket', 'day_type']
-        if mode == "pickup"
-        else ['city', 'lng', 'lat', 'aoi_type', 'delivery_distance_km',
-              'accept_hour', 'delivery_hour', 'accept_day', 'delivery_day',
-              'accept_month', 'delivery_month', 'accept_date', 'delivery_date',
-              'day_type', 'hour_bucket']
+# One specialized predict function per mode
+HANDLERS = {
+    "pickup": make_predictor(
+        "pickup", PICKUP_COLS, PICKUP_CAT_IDX, PICKUP_NUM_IDX, PICKUP_MIN, PICKUP_INV_RANGE,
+        pickup_model, batcher, SAMPLE_PICKUP_PAYLOAD
+    ),
+    "delivery": make_predictor(
+        "delivery", DELIVERY_COLS, DELIVERY_CAT_IDX, DELIVERY_NUM_IDX, DELIVERY_MIN, DELIVERY_INV_RANGE,
+        delivery_model, batcher, SAMPLE_DELIVERY_PAYLOAD
     )
+}
 
-    for col in expected_cols:
-        if col not in df.columns:
-            df[col] = np.nan
 
-    return df[expected_cols]
+class PredictRequest(msgspec.Struct):
+    """POST /predict body; features may also be sent at the top level."""
+    mode: str = "pickup"
+    features: dict | None = None
+    # set by clients that already applied the *_scaling_params.json min-max scaling
+    normalized: bool = False
 
 
-def predict_eta(payload, mode):
-    """Predict ETA (actual minutes) from real input data."""
-    for col, val in payload.items():
-        if isinstance(val, (int, float)):
-            payload[col] = normalize_value(val, col, mode)
+class EtaResponse(msgspec.Struct, omit_defaults=True):
+    """POST /predict success body (processing_time_sec only when timing is reported)."""
+    mode: str
+    eta_normalized: float
+    eta_minutes: float
+    processing_time_sec: float | None = None
 
-    X = preprocess_payload(payload, mode)
-    model = pickup_model if mode == "pickup" else delivery_model
 
-    eta_norm = float(model.predict(X)[0])
+json_encoder = msgspec.json.Encoder()
 
-    eta_min = eta_scaling[mode]["eta_min"]
-    eta_max = eta_scaling[mode]["eta_max"]
-    eta_actual = eta_norm * (eta_max - eta_min) + eta_min
 
-    return eta_actual, eta_norm
+def _json(obj, status=200):
+    """Serialize a response body (dict or msgspec Struct) with msgspec."""
+    return Response(json_encoder.encode(obj), status=status, mimetype="application/json")
 
 
 # -------------------- ROUTES --------------------
 @app.route("/")
 def home():
-    return jsonify({
+    return _json({
         "message": "✅ ETA Prediction API is running.",
         "usage": "Send a POST request to /predict with JSON data (mode + features)."
     })
@@ -116,34 +322,39 @@ def home():
 
 @app.route("/predict", methods=["POST"])
 def predict():
-    start_time = time.time()
+    start_ns = time.perf_counter_ns()
     try:
-        data = request.get_json(force=True)
+        # cache=False: the body is decoded once here and never re-read from the request
+        raw = request.get_data(cache=False)
+        # Decode once; malformed JSON or a wrongly typed field is a client error
+        try:
+            body = msgspec.json.decode(raw)
+            data = msgspec.convert(body, PredictRequest)
+        except (msgspec.ValidationError, msgspec.DecodeError) as e:
+            return _json({"error": str(e)}, 400)
 
         # allow both formats (with or without "features")
-        mode = data.get("mode", "pickup")
-        payload = data.get("features", data)
+        mode = data.mode
+        payload = data.features if data.features is not None else body
 
-        if mode not in ["pickup", "delivery"]:
-            return jsonify({"error": "Invalid mode. Must be 'pickup' or 'delivery'"}), 400
+        predict_eta = HANDLERS.get(mode)
+        if predict_eta is None:
+            return _json({"error": "Invalid mode. Must be 'pickup' or 'delivery'"}, 400)
 
-        eta_actual, eta_norm = predict_eta(payload, mode)
+        eta_actual, eta_norm = predict_eta(payload, data.normalized)
 
-        response = {
-            "mode": mode,
-            "eta_normalized": round(eta_norm, 4),
-            "eta_minutes": round(eta_actual, 2),
-            "processing_time_sec": round(time.time() - start_time, 3)
-        }
+        response = EtaResponse(mode=mode, eta_normalized=eta_norm, eta_minutes=eta_actual)
+        if report_timing or request.args.get("debug") == "1":
+            response.processing_time_sec = (time.perf_counter_ns() - start_ns) / 1e9
 
         # Logging for monitoring
-        logging.info(f"Mode: {mode} | Payload: {payload} | ETA: {response}")
+        logging.info("Mode: %s | Payload: %s | ETA: %s", mode, payload, response)
 
-        return jsonify(response)
+        return _json(response)
 
     except Exception as e:
-        logging.error(f"Prediction error: {e}")
-        return jsonify({"error": str(e)}), 500
+        logging.error("Prediction error: %s", e)
+        return _json({"error": str(e)}, 500)
 
 
 # -------------------- MANUAL TEST MODE --------------------
@@ -155,44 +366,9 @@ def manual_test():
 
     print(f"\n🚀 Running manual ETA test for {mode.upper()} mode...\n")
 
-    if mode == "pickup":
-        payload = {
-            "city": "Chongqing",
-            "lng": 106.55,
-            "lat": 29.56,
-            "aoi_type": 1,
-            "pickup_distance_km": 2.3,
-            "accept_hour": 10,
-            "pickup_hour": 11,
-            "accept_day": 9,
-            "pickup_day": 9,
-            "accept_month": 10,
-            "pickup_month": 10,
-            "accept_date": "2025-10-09",
-            "pickup_date": "2025-10-09",
-            "hour_bucket": "Afternoon",
-            "day_type": "Weekday"
-        }
-    else:
-        payload = {
-            "city": "Chongqing",
-            "lng": 106.55,
-            "lat": 29.56,
-            "aoi_type": 1,
-            "delivery_distance_km": 2.8,
-            "accept_hour": 10,
-            "delivery_hour": 11,
-            "accept_day": 9,
-            "delivery_day": 9,
-            "accept_month": 10,
-            "delivery_month": 10,
-            "accept_date": "2025-10-09",
-            "delivery_date": "2025-10-09",
-            "day_type": "Weekday",
-            "hour_bucket": "Afternoon"
-        }
-
-    eta_actual, eta_norm = predict_eta(payload, mode)
+    payload = SAMPLE_PICKUP_PAYLOAD if mode == "pickup" else SAMPLE_DELIVERY_PAYLOAD
+
+    eta_actual, eta_norm = HANDLERS[mode](payload)
     eta_hours = int(eta_actual // 60)
     eta_minutes = int(eta_actual % 60)
     print(f"🔹 Normalized ETA prediction: {eta_norm:.4f}")
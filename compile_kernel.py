@@ -0,0 +1,18 @@
+"""Ahead-of-time compile the normalization kernel into the eta_kernel extension module.
+
+_normalize.py imports eta_kernel when it is present and falls back to the
+Numba JIT version otherwise. Requires a C compiler.
+
+Usage: python compile_kernel.py
+"""
+from numba.pycc import CC
+
+from _normalize import _normalize_py
+
+cc = CC("eta_kernel")
+cc.export("normalize_vec", "void(f4[:], f4[:], f4[:], f4[:])")(_normalize_py)
+
+
+if __name__ == "__main__":
+    cc.compile()
+    print("✅ Compiled eta_kernel")
@@ -0,0 +1,37 @@
+"""Gunicorn settings for serving app.py (see Dockerfile CMD)."""
+import os
+
+_cpus = sorted(os.sched_getaffinity(0))
+
+
+def _cpu_quota():
+    """Whole CPUs allowed by the cgroup v2 CPU quota, or None if unlimited/unknown."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return max(1, int(quota) // int(period))
+
+
+bind = "0.0.0.0:5000"
+# Every worker loads both models (~260 MB RSS), so only scale out as far as the
+# container's CPU quota allows; without a quota run a single worker like the
+# dev server did. Set WEB_CONCURRENCY to size the pool explicitly.
+workers = int(os.environ.get("WEB_CONCURRENCY", min(len(_cpus), _cpu_quota() or 1)))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+
+
+def pre_fork(server, worker):
+    # Pick the core held by the fewest live workers, so a restarted worker takes
+    # over the core its predecessor left free
+    held = [getattr(w, "cpu", None) for w in server.WORKERS.values()]
+    worker.cpu = min(_cpus, key=held.count)
+
+
+def post_fork(server, worker):
+    os.sched_setaffinity(0, {worker.cpu})
+    server.log.info("Worker %s pinned to CPU %s", worker.pid, worker.cpu)
@@ -1,9 +1,41 @@
+import json
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 
 # ---------------- CONFIG ----------------
 API_URL = "https://eta-model-deployment-streamlit.onrender.com/predict"  # ✅ Your Flask API endpoint
 
+
+@st.cache_resource
+def _session():
+    """Shared HTTP session so predictions reuse the keep-alive connection to the API."""
+    s = requests.Session()
+    s.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+    return s
+
+
+@st.cache_resource
+def _scaling():
+    """Per-mode scaling params (same files the API uses) for normalizing before sending."""
+    scaling = {}
+    for m in ("pickup", "delivery"):
+        with open(f"{m}_scaling_params.json", "r") as f:
+            scaling[m] = json.load(f)
+    return scaling
+
+
+def normalize_features(features, mode):
+    """Min-max scale numeric features the same way the API does."""
+    scaling = _scaling()[mode]
+    normalized = dict(features)
+    for col, params in scaling.items():
+        if col in normalized:
+            vmin, vmax = params["min"], params["max"]
+            normalized[col] = 0 if vmax == vmin else (normalized[col] - vmin) / (vmax - vmin)
+    return normalized
+
+
 st.set_page_config(page_title="ETA Predictor", page_icon="🚚", layout="centered")
 
 st.title("🚚 ETA Prediction App")
@@ -57,15 +89,18 @@ if st.button("🔮 Predict ETA"):
             "hour_bucket": hour_bucket,
             "day_type": day_type,
         },
+        "normalized": True,
     }
+    payload["features"] = normalize_features(payload["features"], mode)
 
     try:
-        response = requests.post(API_URL, json=payload)
+        # debug=1 asks the API for processing_time_sec; long read timeout covers Render cold starts
+        response = _session().post(API_URL, params={"debug": 1}, json=payload, timeout=(5, 60))
         if response.status_code == 200:
             data = response.json()
-            st.success(f"✅ ETA Predicted: {data['eta_minutes']} minutes")
-            st.metric("Normalized ETA", f"{data['eta_normalized']}")
-            st.metric("Processing Time", f"{data['processing_time_sec']} sec")
+            st.success(f"✅ ETA Predicted: {data['eta_minutes']:.2f} minutes")
+            st.metric("Normalized ETA", f"{data['eta_normalized']:.4f}")
+            st.metric("Processing Time", f"{data['processing_time_sec']:.3f} sec")
         else:
             st.error(f"API Error: {response.text}")
     except Exception as e: